@@ -3,6 +3,8 @@
 import sys
 import json
 import time
+import threading
+from datetime import datetime, timezone
 from concurrent.futures import ThreadPoolExecutor
 from google.cloud import storage, bigquery
 from google.cloud.exceptions import NotFound
@@ -25,6 +27,7 @@ FINAL_COUNTER = None # Final value counter should be iterated to after successfu
 MANIFEST = None # Manifest content read from cloud storage
 EXPORT = None # Current export based on counter from manifest
 ROOT_URL = None # Root url for export to build full path to all files loaded below
+CHANGES = {} # Tables/partitions changed by current export, keyed by (table name, period id), used to build change record
 
 # Global config
 MAX_NUM_TRIES = 3 # Maximum number of tries to load file before exiting program
@@ -32,11 +35,14 @@ MAX_THREADS = 16 # Max number of threads to spread load jobs between in async mo
 MAX_EXPORTS_TO_LOAD = 30 # Max number of exports program will load in a single run. 
                         # Can be adjusted based on volume of exports generated
                         # e.g. Running hourly with max exports set to 100, up to 2400 exports will be processed daily
+WRITE_CHANGE_RECORD = True # If true writes a record of changed tables/partitions to cloud storage and BQ after each export, for incremental downstream refreshes
+CHANGE_TABLE_NAME = 'datasync_changes' # Name of BQ audit table change records are appended to
 
 # Async processing globals
 THREAD_EXECUTOR = ThreadPoolExecutor(MAX_THREADS) # Executor to run async tasks in allocated threads
 JOBS_STARTED = 0 # Number of jobs started, to track when all async jobs have finished
 JOBS_FINISHED = 0 # Number of jobs finished, to track when all async jobs have finished
+CHANGES_LOCK = threading.Lock() # Lock guarding CHANGES, which is updated from job callbacks in executor threads
 
 print(f"Loading Pendo data from {GCP_BUCKET}{GCP_PATH} to project {GCP_PROJECT}, dataset {GCP_DATASET}")
 
@@ -45,6 +51,15 @@ def read_json(blob_name):
     blob = BUCKET.blob(blob_name)
     with blob.open('r') as f:
         return json.loads(blob.download_as_string(client=None))
+
+# Add rows/bytes from finished load job to change record for table and partition (period id is None for definition tables)
+def record_change(table_name, period_id, job):
+    with CHANGES_LOCK:
+        change = CHANGES.setdefault((table_name, period_id), {'rowsLoaded': 0, 'bytesLoaded': 0, 'filesLoaded': 0})
+        change['rowsLoaded'] += job.output_rows or 0
+        change['bytesLoaded'] += job.output_bytes or 0
+        change['filesLoaded'] += 1
+    return
     
 # Submit job to thread executor upon creation and add one to number of jobs started
 def start_job(job_obj):
@@ -55,11 +70,14 @@ def start_job(job_obj):
     return
 
 # Validate result of job upon finish and add one to number of jobs finished
+# Job is only counted as finished after validation, so next job in series is started and change record is updated before main loop can see all jobs finished
 def job_finished(future):
     global JOBS_FINISHED
-    JOBS_FINISHED += 1
-    job = future.result()
-    validate_async(job)
+    try:
+        job = future.result()
+        validate_async(job)
+    finally:
+        JOBS_FINISHED += 1
     return
 
 # Function to run async GCP jobs required for loading tables
@@ -101,6 +119,10 @@ def validate_async(async_job):
             print(f"\tJob {async_job['job']} failed with errors {async_job['job'].errors} after {async_job['job_obj']['attempt_number']} attempts. Exiting.")
             sys.exit()
 
+    # Track rows/bytes loaded for change record
+    if (async_job['job_obj']['type'] == 'load'):
+        record_change(async_job['job_obj']['change']['table_name'], async_job['job_obj']['change']['period_id'], async_job['job'])
+
     # If there are other async steps to follow, kick the next step off
     if (async_job['next'] != None):
         print(f"\tNext job: {async_job['next']}")
@@ -130,6 +152,7 @@ def load_definitions_tables(definition_files, table_name):
                         use_avro_logical_types=True # Convert Avro logical types to BQ types (e.g. TIMESTAMP) rather than raw types (e.g. INTEGER)
                     ),
                 },
+                'change': { 'table_name': table_name, 'period_id': None }, # Table/partition to attribute loaded rows to in change record
                 'attempt_number': 1,
                 'next': None
             })
@@ -183,6 +206,7 @@ def load_events_tables(event_files, period_id, table_name): # uri, table_id, per
                     'table_id': f"{GCP_PROJECT}.{GCP_DATASET}.{table_name}",
                     'job_config': job_config,
                 },
+                'change': { 'table_name': table_name, 'period_id': period_id }, # Table/partition to attribute loaded rows to in change record
                 'attempt_number': 1,
                 'next': None
             })
@@ -212,6 +236,7 @@ def load_events_tables(event_files, period_id, table_name): # uri, table_id, per
                     'table_id': f"{GCP_PROJECT}.{GCP_DATASET}.{table_name}_temp",
                     'job_config': job_config,
                 },
+                'change': { 'table_name': table_name, 'period_id': period_id }, # Table/partition to attribute loaded rows to in change record
                 'attempt_number': 1,
                 'next': None
             },
@@ -244,6 +269,7 @@ def load_events_tables(event_files, period_id, table_name): # uri, table_id, per
                         'table_id': f"{GCP_PROJECT}.{GCP_DATASET}.{table_name}",
                         'job_config': job_config,
                     },
+                    'change': { 'table_name': table_name, 'period_id': period_id }, # Table/partition to attribute loaded rows to in change record
                     'attempt_number': 1,
                     'next': None
                 })
@@ -343,6 +369,66 @@ def load_events():
                 load_events_tables(matched_event['files'], period_id, event_id)
     return
 
+# Write record of tables/partitions changed by export so downstream transforms can refresh only affected partitions
+# 1. Save change record as JSON to changes/<COUNTER>.json next to counter.json
+# 2. Append change record rows to BQ audit table
+def write_change_record():
+    print(f"Writing change record for export {COUNTER}.")
+
+    loaded_at = datetime.now(timezone.utc).isoformat()
+    changes = [{
+        'counter': COUNTER,
+        'rootUrl': ROOT_URL,
+        'loadedAt': loaded_at,
+        'tableName': table_name,
+        'periodId': f"{period_id[0:4]}-{period_id[4:6]}-{period_id[6:8]}" if period_id != None else None, # Format period id as BQ DATE, None for definition tables
+        **change
+    } for (table_name, period_id), change in CHANGES.items()]
+
+    # 1. Save change record as JSON to changes/<COUNTER>.json next to counter.json
+    try:
+        print(f"\tSaving change record to {GCP_PATH}/changes/{COUNTER}.json")
+        blob = BUCKET.blob(f"{GCP_PATH}/changes/{COUNTER}.json")
+        blob.upload_from_string(
+            data=json.dumps({
+                'counter': COUNTER,
+                'rootUrl': ROOT_URL,
+                'loadedAt': loaded_at,
+                'tables': sorted(set(change['tableName'] for change in changes)),
+                'changes': changes
+            }),
+            content_type='application/json'
+        )
+    except Exception as e:
+        print(f"\tFailed saving change record. Exiting with exception: {str(e)}")
+        sys.exit()
+
+    # 2. Append change record rows to BQ audit table
+    if (len(changes) > 0):
+        job_config = bigquery.LoadJobConfig(
+            schema=[
+                bigquery.SchemaField('counter', 'INTEGER', mode='REQUIRED'),
+                bigquery.SchemaField('rootUrl', 'STRING'),
+                bigquery.SchemaField('loadedAt', 'TIMESTAMP', mode='REQUIRED'),
+                bigquery.SchemaField('tableName', 'STRING', mode='REQUIRED'),
+                bigquery.SchemaField('periodId', 'DATE'), # Null for definition tables, which are truncated on each export
+                bigquery.SchemaField('rowsLoaded', 'INTEGER'),
+                bigquery.SchemaField('bytesLoaded', 'INTEGER'),
+                bigquery.SchemaField('filesLoaded', 'INTEGER')
+            ],
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND # Always append change records
+        )
+
+        try:
+            print(f"\tAppending {len(changes)} rows to {GCP_PROJECT}.{GCP_DATASET}.{CHANGE_TABLE_NAME}")
+            job = BIGQUERY_CLIENT.load_table_from_json(changes, f"{GCP_PROJECT}.{GCP_DATASET}.{CHANGE_TABLE_NAME}", job_config=job_config)
+            result = job.result() # Waits for the job to complete.
+            print(f"\tResult: {result}")
+        except Exception as e:
+            print(f"\tFailed appending change record to {CHANGE_TABLE_NAME}. Exiting with exception: {str(e)}")
+            sys.exit()
+    return
+
 # After loading is completed perform any necessary cleanup
 # 1. Iterate and save counter file
 # Optionally you may want to delete loaded exports here
@@ -378,6 +464,11 @@ while(COUNTER <= FINAL_COUNTER):
 
     print(f"All jobs finished for export with {COUNTER}. Moving on to next export.")
 
+    # Record tables/partitions changed by export and reset for next export
+    if (WRITE_CHANGE_RECORD):
+        write_change_record()
+    CHANGES = {}
+
     # Iterate counter and associated globals 
     try:
         COUNTER = COUNTER + 1
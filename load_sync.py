@@ -3,6 +3,7 @@
 
 import sys
 import json
+from datetime import datetime, timezone
 from google.cloud import storage, bigquery
 from google.cloud.exceptions import NotFound
 
@@ -23,10 +24,13 @@ COUNTER = None # Global counter from cloud storage indicating what export to loa
 MANIFEST = None # Manifest content read from cloud storage
 EXPORT = None # Current export based on counter from manifest
 ROOT_URL = None # Root url for export to build full path to all files loaded below
+CHANGES = {} # Tables/partitions changed by this export, keyed by (table name, period id), used to build change record
 
 # Global config
 MAX_NUM_TRIES = 3 # Maximum number of tries to load file before exiting program
 VALIDATE_LOAD = True # If true validates load by retrieving table and printing current table size
+WRITE_CHANGE_RECORD = True # If true writes a record of changed tables/partitions to cloud storage and BQ after each export, for incremental downstream refreshes
+CHANGE_TABLE_NAME = 'datasync_changes' # Name of BQ audit table change records are appended to
 
 print(f"Loading Pendo data from {GCP_BUCKET}{GCP_PATH_TO_EXPORT} to project {GCP_PROJECT}, dataset {GCP_DATASET}")
 
@@ -36,8 +40,16 @@ def read_json(blob_name):
     with blob.open('r') as f:
         return json.loads(blob.download_as_string(client=None))
 
+# Add rows/bytes from finished load job to change record for table and partition (period id is None for definition tables)
+def record_change(table_name, period_id, job):
+    change = CHANGES.setdefault((table_name, period_id), {'rowsLoaded': 0, 'bytesLoaded': 0, 'filesLoaded': 0})
+    change['rowsLoaded'] += job.output_rows or 0
+    change['bytesLoaded'] += job.output_bytes or 0
+    change['filesLoaded'] += 1
+    return
+
 # Load definition table based on supplied configuration
-def load_definitions_table(uri, table_id, write_disposition):
+def load_definitions_table(uri, table_id, table_name, write_disposition):
     job_config = bigquery.LoadJobConfig(
         source_format=bigquery.SourceFormat.AVRO, # Specify Avro file format 
         write_disposition=write_disposition, # Write disposition (truncate/append)
@@ -53,6 +65,7 @@ def load_definitions_table(uri, table_id, write_disposition):
             job = BIGQUERY_CLIENT.load_table_from_uri(uri, table_id, job_config=job_config)
             result = job.result() # Waits for the job to complete.
             print(f"\t\t\tResult: {result}")
+            record_change(table_name, None, job)
 
             # Validate 
             if (VALIDATE_LOAD):
@@ -71,7 +84,7 @@ def load_definitions_table(uri, table_id, write_disposition):
     return
 
 # Load event table based on supplied configuration
-def load_events_table(uri, table_id, period_id, file_index):
+def load_events_table(uri, table_id, table_name, period_id, file_index):
     job_config = bigquery.LoadJobConfig(
         source_format=bigquery.SourceFormat.AVRO, # Specify Avro file format 
         write_disposition=bigquery.WriteDisposition.WRITE_APPEND, # Always append events
@@ -98,6 +111,7 @@ def load_events_table(uri, table_id, period_id, file_index):
                 job = BIGQUERY_CLIENT.load_table_from_uri(uri, table_id, job_config=job_config)
                 result = job.result() # Waits for the job to complete.
                 print(f"\t\t\tResult: {result}")
+                record_change(table_name, period_id, job)
 
                 # Validate 
                 if (VALIDATE_LOAD):
@@ -107,8 +121,8 @@ def load_events_table(uri, table_id, period_id, file_index):
             except NotFound:
                 # Send load job
                 print(f"\t\t\tTable {table_id} is not found. Creating temp table {table_id}_temp to load from. (attempt {num_tries})")
-                job = BIGQUERY_CLIENT.load_table_from_uri(uri, f"{table_id}_temp", job_config=job_config)
-                result = job.result() # Waits for the job to complete.
+                load_job = BIGQUERY_CLIENT.load_table_from_uri(uri, f"{table_id}_temp", job_config=job_config)
+                result = load_job.result() # Waits for the job to complete.
                 print(f"\t\t\tResult: {result}")
 
                 # Copy from temp table with partitioning
@@ -122,6 +136,7 @@ def load_events_table(uri, table_id, period_id, file_index):
                 job = BIGQUERY_CLIENT.query(f"DROP TABLE `{table_id}_temp`")
                 result = job.result() # Waits for the job to complete.
                 print(f"\t\t\tResult: {result}")
+                record_change(table_name, period_id, load_job) # Rows loaded to temp table now live in partitioned table
 
                 # Validate 
                 if (VALIDATE_LOAD):
@@ -204,6 +219,7 @@ def load_definitions():
                 load_definitions_table(
                     f"{ROOT_URL}/{definition_file}", # Source file URI
                     f"{GCP_PROJECT}.{GCP_DATASET}.{definition_table_names[i]}", # Destination table name
+                    definition_table_names[i], # Table name for change record
                     bigquery.WriteDisposition.WRITE_TRUNCATE if j == 0 else bigquery.WriteDisposition.WRITE_APPEND # Truncate for first file in array, otherwise append
                 )
 
@@ -220,6 +236,7 @@ def load_events():
                 load_events_table(
                     f"{ROOT_URL}/{all_events_file}", # Source file URI
                     f"{GCP_PROJECT}.{GCP_DATASET}.allevents", # Destination table name,
+                    'allevents', # Table name for change record
                     period_id, # Period id of partition to load data to
                     i # Index of file, to determine whether data should be dropped
                 )
@@ -233,10 +250,71 @@ def load_events():
                     load_events_table(
                         f"{ROOT_URL}/{matched_event_file}", # Source file URI
                         f"{GCP_PROJECT}.{GCP_DATASET}.{matched_event['id'].split('/')[1]}", # Destination table name,
+                        matched_event['id'].split('/')[1], # Table name for change record
                         period_id, # Period id of partition to load data to
                         j # Index of file, to determine whether data should be dropped
                     ) 
 
+# Write record of tables/partitions changed by export so downstream transforms can refresh only affected partitions
+# 1. Save change record as JSON to changes/<COUNTER>.json next to counter.json
+# 2. Append change record rows to BQ audit table
+def write_change_record():
+    print(f"Writing change record for export {COUNTER}.")
+
+    loaded_at = datetime.now(timezone.utc).isoformat()
+    changes = [{
+        'counter': COUNTER,
+        'rootUrl': ROOT_URL,
+        'loadedAt': loaded_at,
+        'tableName': table_name,
+        'periodId': f"{period_id[0:4]}-{period_id[4:6]}-{period_id[6:8]}" if period_id != None else None, # Format period id as BQ DATE, None for definition tables
+        **change
+    } for (table_name, period_id), change in CHANGES.items()]
+
+    # 1. Save change record as JSON to changes/<COUNTER>.json next to counter.json
+    try:
+        print(f"\tSaving change record to {GCP_PATH_TO_EXPORT}/changes/{COUNTER}.json")
+        blob = BUCKET.blob(f"{GCP_PATH_TO_EXPORT}/changes/{COUNTER}.json")
+        blob.upload_from_string(
+            data=json.dumps({
+                'counter': COUNTER,
+                'rootUrl': ROOT_URL,
+                'loadedAt': loaded_at,
+                'tables': sorted(set(change['tableName'] for change in changes)),
+                'changes': changes
+            }),
+            content_type='application/json'
+        )
+    except Exception as e:
+        print(f"\tFailed saving change record. Exiting with exception: {str(e)}")
+        sys.exit()
+
+    # 2. Append change record rows to BQ audit table
+    if (len(changes) > 0):
+        job_config = bigquery.LoadJobConfig(
+            schema=[
+                bigquery.SchemaField('counter', 'INTEGER', mode='REQUIRED'),
+                bigquery.SchemaField('rootUrl', 'STRING'),
+                bigquery.SchemaField('loadedAt', 'TIMESTAMP', mode='REQUIRED'),
+                bigquery.SchemaField('tableName', 'STRING', mode='REQUIRED'),
+                bigquery.SchemaField('periodId', 'DATE'), # Null for definition tables, which are truncated on each export
+                bigquery.SchemaField('rowsLoaded', 'INTEGER'),
+                bigquery.SchemaField('bytesLoaded', 'INTEGER'),
+                bigquery.SchemaField('filesLoaded', 'INTEGER')
+            ],
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND # Always append change records
+        )
+
+        try:
+            print(f"\tAppending {len(changes)} rows to {GCP_PROJECT}.{GCP_DATASET}.{CHANGE_TABLE_NAME}")
+            job = BIGQUERY_CLIENT.load_table_from_json(changes, f"{GCP_PROJECT}.{GCP_DATASET}.{CHANGE_TABLE_NAME}", job_config=job_config)
+            result = job.result() # Waits for the job to complete.
+            print(f"\tResult: {result}")
+        except Exception as e:
+            print(f"\tFailed appending change record to {CHANGE_TABLE_NAME}. Exiting with exception: {str(e)}")
+            sys.exit()
+    return
+
 # After loading is completed perform any necessary cleanup
 # 1. Iterate and save counter file
 def cleanup():
@@ -258,4 +336,6 @@ def cleanup():
 setup()
 load_definitions()
 load_events()
+if (WRITE_CHANGE_RECORD):
+    write_change_record()
 # cleanup() # Disabled by default to prevent iterating counter during testing
\ No newline at end of file